@@ -1,12 +1,25 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import sys
 import simpleaudio
 import argparse
 import re
+import io
+import json
+import time
+import wave
+import shutil
+import random
+import hashlib
+import tempfile
+import contextlib
+import threading
 import numpy as np
 import datetime
+from multiprocessing import shared_memory
 from string import Template
+from collections import namedtuple
 from nltk.corpus import cmudict
 
 __author__ = "Kleber Noel"
@@ -23,7 +36,7 @@ parser.add_argument('--diphones', default="./diphones", help="Folder containing
 parser.add_argument('--play', '-p', action="store_true", default=False, help="Play the output audio")
 parser.add_argument('--outfile', '-o', action="store", dest="outfile", type=str, help="Save the output audio to a file",
                     default=None)
-parser.add_argument('phrase', nargs=1, help="The phrase to be synthesised")
+parser.add_argument('phrase', nargs='?', default=None, help="The phrase to be synthesised")
 
 parser.add_argument('--spell', '-s', action="store_true", default=False,
                     help="Spell the phrase instead of pronouncing it")
@@ -31,18 +44,284 @@ parser.add_argument('--crossfade', '-c', action="store_true", default=False,
 					help="Enable slightly smoother concatenation by cross-fading between diphone units")
 parser.add_argument('--volume', '-v', default=None, type=int,
                     help="An int between 0 and 100 representing the desired volume")
+parser.add_argument('--rate', '-r', default=1.0, type=float,
+                    help="Speaking rate, e.g. 1.5 for faster or 0.75 for slower speech (default 1.0)")
+parser.add_argument('--pause-rate', dest="pause_rate", default=None, type=float,
+                    help="Rate by which to shorten or lengthen the punctuation pauses (default: same as --rate)")
+parser.add_argument('--bank', '-b', default=None, type=str,
+                    help="Attach to the shared diphone bank published under this name instead of loading the wavs")
+parser.add_argument('--publish-bank', dest="publish_bank", default=None, type=str,
+                    help="Load the diphones and lexicon once into shared memory under this name and serve them")
+parser.add_argument('--build-bank', dest="build_bank", nargs=2, metavar=('CORPUS', 'OUTDIR'), default=None,
+                    help="Copy only the diphones needed to say every line of CORPUS (and their fallbacks) into OUTDIR")
+parser.add_argument('--estimate', '-e', action="store_true", default=False,
+                    help="Print the duration and cost of the phrase as json instead of synthesising it")
+parser.add_argument('--manifest', '-m', default=None, type=str,
+                    help="Keep an index of the diphone files in this json file, so only changed files are re-read")
+parser.add_argument('--cache', default=None, type=str,
+                    help="Folder in which to keep rendered audio, to be reused for identical requests")
+parser.add_argument('--cache-size', dest="cache_size", default=512, type=int,
+                    help="Largest size of the audio cache in megabytes (default 512)")
+parser.add_argument('--coverage-report', dest="coverage_report", default=None, type=str,
+                    help="With --build-bank, also save the coverage report as json to this file")
 
 args = parser.parse_args()
-cmu = cmudict.dict()
+
+# The phone inventory (CMU phones without stress, plus the pause). Phones are
+# passed through the pipeline as their index in this tuple.
+PHONES = ('pau', 'aa', 'ae', 'ah', 'ao', 'aw', 'ay', 'b', 'ch', 'd', 'dh', 'eh', 'er', 'ey', 'f', 'g',
+          'hh', 'ih', 'iy', 'jh', 'k', 'l', 'm', 'n', 'ng', 'ow', 'oy', 'p', 'r', 's', 'sh', 't', 'th',
+          'uh', 'uw', 'v', 'w', 'y', 'z', 'zh')
+PHONE_IDS = {phone: i for i, phone in enumerate(PHONES)}
+PAU = PHONE_IDS['pau']
+
+# Milliseconds of silence added after a pause brought in by punctuation
+PAUSE_LENGTHS = {'.': 400, ':': 400, '?': 400, '!': 400, ',': 200, ';': 200}
+
+# The pronunciation Lexicon, compiled from cmudict the first time it is needed
+# (or shared through --bank); use get_lexicon() rather than reading it directly
+cmu = None
+
+
+class DiphoneSeq(namedtuple('DiphoneSeq', ['left', 'right', 'pause'])):
+    """
+    A diphone sequence as three parallel arrays: the phone IDs on the left
+    and right of each diphone and the milliseconds of silence that follow it.
+    """
+    def names(self):
+        """
+        :return: the diphones as '<phone>-<phone>' strings
+        """
+        return ['{}-{}'.format(PHONES[l], PHONES[r]) for l, r in zip(self.left, self.right)]
 
 class Synth:
     """
     All synthesis procedures are dealt with here or in simpleaudio.
     """
-    def __init__(self, wav_folder):
+    def __init__(self, wav_folder, bank=None, manifest=None):
         self.diphones = {}
-        self.get_wavs(wav_folder)
+        self.bank = bank
+        self.manifest = manifest
+        self.wavs = {}
+        self.samples = None
+        self.fallbacks = {}
+        self.lock = threading.Lock()
         self.wav_folder=wav_folder
+        self.get_wavs(wav_folder) if bank is None else self.get_bank_wavs()
+        self.unit_names=list(self.diphones)
+        self.table=self.unit_table(self.unit_names)
+
+    def fingerprint(self):
+        """
+        :return: a hash identifying the contents of the bank and lexicon (see bank_fingerprint)
+        """
+        return bank_fingerprint(self.wav_folder, self.bank, self.manifest)
+
+    def reload(self):
+        """
+        Brings the manifest up to date and swaps in a new index, dropping
+        the loaded audio of every diphone that changed. Requests already
+        being synthesised keep the index they started with.
+
+        :return: the set of diphones that were added, changed or removed
+        """
+        self.check_reloadable()
+        changed, removed = self.manifest.update()
+        if not (changed or removed):
+            return set()
+
+        diphones = {d: entry['file'] for d, entry in self.manifest.entries.items()}
+        unit_names = list(diphones)
+        table = self.unit_table(unit_names)
+        samples = self.unit_samples(unit_names, diphones)
+
+        # Start a new audio store without the changed diphones; requests that are
+        # already running keep loading into (and reading from) the old one
+        wavs = {d: wav for d, wav in dict(self.wavs).items() if d not in changed | removed}
+
+        # load the new audio now rather than in the middle of the next request
+        for diphone in changed:
+            try:
+                self.load_wav(diphone, diphones, wavs)
+            except Exception as e:
+                printdots(['Could not preload {}: {}'.format(diphone, e)])
+
+        with self.lock:
+            self.diphones, self.unit_names, self.table = diphones, unit_names, table
+            self.samples, self.fallbacks, self.wavs = samples, {}, wavs
+
+        return changed | removed
+
+    def check_reloadable(self):
+        """
+        Only a Synth built with a Manifest can reload: a shared bank cannot
+        be changed once published, and a plain folder has no record of what
+        it loaded to compare against.
+
+        :return: None, or raises ValueError
+        """
+        if self.bank is not None:
+            raise ValueError('A shared bank cannot be reloaded; publish a new one instead')
+        if self.manifest is None:
+            raise ValueError('Reloading needs a Synth built with a Manifest (--manifest)')
+
+    def watch(self, seconds=2.0):
+        """
+        Starts a background thread that calls reload every few seconds, so
+        that replaced diphone files are picked up without a restart.
+
+        :param seconds: the polling interval
+        :return: a threading.Event that stops the watcher when set
+        """
+        self.check_reloadable()
+        stop = threading.Event()
+
+        def poll():
+            while not stop.wait(seconds):
+                # Keep watching whatever goes wrong with one reload
+                try:
+                    reloaded = self.reload()
+                except Exception as e:
+                    printdots(['Reload failed: {}'.format(e)])
+                    continue
+                if reloaded:
+                    printdots(['Reloaded {} diphones: {}'.format(len(reloaded), ' '.join(sorted(reloaded)))])
+
+        threading.Thread(target=poll, daemon=True).start()
+        return stop
+
+    def unit_samples(self, unit_names, diphones):
+        """
+        Finds the number of samples in every diphone from the shared
+        bank index or the manifest if there is one. Without either, the
+        counts are left as -1 for fill_samples to read from the file
+        headers as units are needed.
+
+        :param unit_names: the diphones in the order they are numbered
+        :param diphones: the diphones dictionary (diphone -> file)
+        :return: an int64 array parallel to unit_names
+        """
+        if self.bank is not None:
+            return np.diff(self.bank.arrays['offsets'])
+        if self.manifest is not None:
+            return np.array([self.manifest.entries[d]['samples'] for d in unit_names], dtype=np.int64)
+        return np.full(len(unit_names), -1, dtype=np.int64)
+
+    def fill_samples(self, units, unit_names, diphones, samples):
+        """
+        Reads the headers of the given units whose sample counts are
+        not known yet.
+
+        :param units: indices into unit_names
+        :param unit_names: the diphones in the order they are numbered
+        :param diphones: the diphones dictionary (diphone -> file)
+        :param samples: the array of sample counts to fill in
+        :return: None, but updates samples
+        """
+        for i in np.unique(units[samples[units] < 0]):
+            with wave.open(str(self.wav_folder + '/' + diphones[unit_names[i]]), 'rb') as w:
+                samples[i] = w.getnframes()
+
+    def estimate(self, diphoneseq, crossfade=False, rate=1.0, pause_rate=None):
+        """
+        Works out exactly how long synthesize would make a diphone
+        sequence, and how much work it would be, from the sample counts
+        of the diphones alone (no audio is loaded).
+        :param diphoneseq: a DiphoneSeq
+        :param crossfade: as for synthesize
+        :param rate: as for synthesize
+        :param pause_rate: as for synthesize
+        :return: a dict of the output length in samples and seconds, the number
+        of units, pauses, emergency (fallback) diphones and diphones with no fallback
+        """
+        pause_rate = rate if pause_rate is None else pause_rate
+        fs = 16000
+
+        with self.lock:
+            if self.samples is None:
+                self.samples = self.unit_samples(self.unit_names, self.diphones)
+            diphones, unit_names, table = self.diphones, self.unit_names, self.table
+            samples, fallbacks = self.samples, self.fallbacks
+
+        units = table[diphoneseq.left, diphoneseq.right]
+        self.fill_samples(units[units >= 0], unit_names, diphones, samples)
+        lengths = samples[np.maximum(units, 0)] if len(samples) else np.zeros(len(units), dtype=np.int64)
+
+        # Missing diphones are measured by the emergency diphone synthesize would use
+        lost = np.flatnonzero(units < 0)
+        missing = 0
+        for i in lost:
+            key = '{}-{}'.format(PHONES[diphoneseq.left[i]], PHONES[diphoneseq.right[i]])
+            if key not in fallbacks:
+                backupkey = self.emergency_diphone(key, diphones)
+                if backupkey is not None:
+                    backup = np.array([unit_names.index(backupkey)])
+                    self.fill_samples(backup, unit_names, diphones, samples)
+                    fallbacks[key] = samples[backup[0]]
+                else:
+                    fallbacks[key] = None
+            if fallbacks[key] is None:
+                missing += 1
+            lengths[i] = fallbacks[key] or 0
+
+        # The same arithmetic as synthesize and add_silence use for the pauses
+        paused = diphoneseq.pause != 0
+        silences = (diphoneseq.pause[paused] / 1000 * rate / pause_rate * fs).astype(np.int64)
+
+        total = int(lengths.sum() + silences.sum())
+        pieces = len(units) + len(silences)
+        if crossfade and pieces:
+            # each piece after the first overlaps the previous one by a window
+            total -= int(0.01 * fs) * (pieces - 1)
+        if rate != 1:
+            total = int(round(total / rate))
+
+        return {'samples': total,
+                'seconds': total / fs,
+                'units': len(units),
+                'pauses': len(silences),
+                'fallbacks': len(lost) - missing,
+                'missing': missing}
+
+    def estimate_phrase(self, phrase, crossfade=False, rate=1.0, pause_rate=None):
+        """
+        Runs the front end on a phrase and estimates its synthesis.
+        :param phrase: the phrase to be synthesised
+        :param crossfade: as for synthesize
+        :param rate: as for synthesize
+        :param pause_rate: as for synthesize
+        :return: the dict from estimate, with the number of out of vocabulary words as 'oov'
+        """
+        utt = Utterance(phrase)
+        estimate = self.estimate(utt.get_phone_seq(), crossfade, rate=rate, pause_rate=pause_rate)
+        estimate['oov'] = len(utt.oov)
+        return estimate
+
+    def unit_table(self, unit_names):
+        """
+        Builds a 2-D lookup table from a pair of phone IDs to the position
+        of that diphone in unit_names (or the shared bank), with -1
+        where the diphone is missing.
+
+        :param unit_names: the diphones in the order they are numbered
+        :return: an int32 array of shape (len(PHONES), len(PHONES))
+        """
+        table = np.full((len(PHONES), len(PHONES)), -1, dtype=np.int32)
+        for i, diphone in enumerate(unit_names):
+            left, _, right = diphone.partition('-')
+            if left in PHONE_IDS and right in PHONE_IDS:
+                table[PHONE_IDS[left], PHONE_IDS[right]] = i
+        return table
+
+    def get_bank_wavs(self):
+        """
+        Fill the diphones dictionary from the index of a shared bank
+        rather than walking the diphones directory.
+
+        :return: self.diphones dict updated
+        """
+        for diphone in self.bank.names():
+            self.diphones[diphone]=diphone+'.wav'
 
     def get_wavs(self, wav_folder):
         """
@@ -53,66 +332,64 @@ class Synth:
         '.wav' extension. The strings are updated the diphones
         dictionary with diphones as keys and files as values.
 
+        With a manifest, only the files that changed since it was saved
+        are read again.
+
         :param wav_folder: diphones directory
         :return: self.diphones dict updated
         """
+        if self.manifest is not None:
+            self.manifest.update()
+            for diphone, entry in self.manifest.entries.items():
+                self.diphones[diphone]=entry['file']
+            return
+
         for root, dirs, files in os.walk(wav_folder, topdown=False):
             for file in files:
-                if file[0:2]!='._':
+                if file[0:2]!='._' and file.endswith('.wav'):
                     diphone=re.sub('(.wav)','',file)
                     self.diphones[diphone]=file
 
-    def synthesize(self, diphonelist, crossfade=False):
+    def synthesize(self, diphoneseq, crossfade=False, rate=1.0, pause_rate=None):
         """
-        This function checks for silence and appends diphones to a
-        :param diphonelist: a list of diphones to be synthesized
+        This function looks up every diphone in the table, appends its
+        audio and any pause that follows it.
+        :param diphoneseq: a DiphoneSeq to be synthesized
         :param crossfade: argument passed through argpass that decides whether to crossfade diphones
+        :param rate: speaking rate (>1 is faster), applied to the joined waveform with change_rate
+        :param pause_rate: rate applied to the pauses (defaults to rate)
         :return:
         """
+        pause_rate = rate if pause_rate is None else pause_rate
         self.diphonesound = simpleaudio.Audio(rate=16000)
         self.diphone_wavdata_list=[]
-        for key in diphonelist:
-            self.silence_length=0
-            try: # Which diphone file should be loaded?
-
-                # Delete silence specification in string form (for now...)
-                key_no_sil=re.sub('[24]','',key)
-
-                # Create the string that can find the diphone file
-                diphone_file = str(self.wav_folder + '/' + self.diphones[key_no_sil])
 
-                # load it
-                self.diphonesound.load(diphone_file)
+        # Which diphone should be loaded? One lookup for the whole sequence (against
+        # the index as it is now, in case a reload happens while synthesizing)
+        with self.lock:
+            diphones, unit_names, table = self.diphones, self.unit_names, self.table
+            self.loading = (diphones, self.wavs)
+        units = table[diphoneseq.left, diphoneseq.right]
 
-                # put audio data into the list (diphone_wavdata_list is a list of arrays)
-                self.diphone_wavdata_list.append(self.diphonesound.data)
+        for i in range(len(units)):
+            if units[i] >= 0:
+                self.load_unit(units[i], unit_names)
 
-            except Exception as e:
-                strings=['Diphone {} not present in dictionary.'.format(e),'Backing off...',
-                      'Searching for a diphone to fill in for {}'.format(e)]
+            else:
+                key = '{}-{}'.format(PHONES[diphoneseq.left[i]], PHONES[diphoneseq.right[i]])
+                strings=['Diphone {} not present in dictionary.'.format(key),'Backing off...',
+                      'Searching for a diphone to fill in for {}'.format(key)]
                 printdots(strings)
 
                 # Attempt an emergency key search
+                backupkey=self.emergency_diphone(key, diphones)
 
-                backupkey=self.emergency_diphone(key)
-
-                # Create the string that can find the diphone file
-                diphone_file = str(self.wav_folder + '/' + self.diphones[backupkey])
+                # load it and put audio data into the list
+                self.load_diphone(backupkey)
 
-                # load it
-                self.diphonesound.load(diphone_file)
-
-                # put audio data into the list (diphone_wavdata_list is a list of arrays)
-                self.diphone_wavdata_list.append(self.diphonesound.data)
-
-            # investigate if a pau item had
-            if key[-1] == '2':
-                # 200ms of silence
-                self.silence_length = 0.2
-
-            if key[-1] == '4':
-                # 400ms of silence
-                self.silence_length = 0.4
+            # pauses are given in milliseconds (200ms or 400ms); change_rate will later
+            # divide them by rate, so stretch them here to end up divided by pause_rate
+            self.silence_length = diphoneseq.pause[i] / 1000 * rate / pause_rate
 
             # append silence to the list if a value was added to variable self.silence_length during loop
             self.add_silence() if self.silence_length!=0 else None
@@ -121,10 +398,57 @@ class Synth:
         self.new_object = self.diphonesound
 
         # join audio data chunks into one waveform
-        self.crossfade() if args.crossfade else self.naively_concatenate()
+        self.crossfade() if crossfade else self.naively_concatenate()
+
+        # change the speaking rate without changing the pitch
+        self.change_rate(rate) if rate != 1 else None
 
         return self.new_object
 
+    def load_diphone(self, diphone):
+        """
+        Loads a diphone by name (as found by emergency_diphone) and
+        appends it to diphone_wavdata_list (a list of arrays).
+
+        :param diphone: a diphone key present in the diphones synthesis started with
+        :return: None
+        """
+        self.diphonesound.data = self.bank.wav(diphone) if self.bank is not None else self.load_wav(diphone, *self.loading)
+        self.diphone_wavdata_list.append(self.diphonesound.data)
+
+    def load_unit(self, unit, unit_names):
+        """
+        Loads the diphone at a position in unit_names, either as a
+        read-only view onto the shared bank or from the diphones
+        directory, and appends it to diphone_wavdata_list.
+
+        :param unit: an index into unit_names
+        :param unit_names: self.unit_names as it was when synthesis started
+        :return: None
+        """
+        self.diphonesound.data = self.bank.unit(unit) if self.bank is not None else \
+            self.load_wav(unit_names[unit], *self.loading)
+        self.diphone_wavdata_list.append(self.diphonesound.data)
+
+    def load_wav(self, diphone, diphones, wavs):
+        """
+        Returns the samples of a diphone file, reading the file only the
+        first time (or after it has been reloaded).
+
+        :param diphone: a diphone key present in diphones
+        :param diphones: the diphones dictionary (diphone -> file) to load from
+        :param wavs: the store of loaded audio that goes with diphones
+        :return: a read-only int16 array
+        """
+        wav = wavs.get(diphone)
+        if wav is None:
+            sound = simpleaudio.Audio(rate=16000)
+            sound.load(str(self.wav_folder + '/' + diphones[diphone]))
+            wav = sound.data
+            wav.flags.writeable = False
+            wavs[diphone] = wav
+        return wav
+
     def naively_concatenate(self):
         self.new_object.data = np.concatenate(self.diphone_wavdata_list, axis=0) # Concatenate the diphone wavdata
 
@@ -204,13 +528,64 @@ class Synth:
         # When outside the loop, concatenate the diphone wavdata
         self.new_object.data = diphones_array
 
-    def emergency_diphone(self,lostkey):
+    def change_rate(self, rate, seconds=0.02, tolerance=0.005):
+        """
+        Changes the speaking rate of the joined waveform by waveform
+        similarity overlap-add (WSOLA): half-overlapping Hann-windowed frames
+        are read rate times faster than they are written, and each one is
+        shifted by up to the tolerance to best continue the previous frame.
+        The overlap-add itself is done for all frames at once.
+        :param rate: speaking rate, >1 is faster
+        :param seconds: frame length
+        :param tolerance: largest shift of a frame, in seconds
+        :return: None, but updates self.new_object.data
+        """
+        data = np.asarray(self.new_object.data, dtype=np.float32)
+
+        # synthesis hop (half a frame), analysis hop and search tolerance in samples
+        hop = max(int(seconds * self.new_object.rate) // 2, 1)
+        framelen = 2 * hop
+        delta = int(tolerance * self.new_object.rate)
+        outlen = int(round(len(data) / rate))
+        nframes = -(-outlen // hop) + 1
+
+        # frame k is written at (k-1)*hop and nominally read from (k-1)*hop*rate;
+        # pad so that every read (and its continuation) stays inside the signal
+        pad = int(np.ceil(hop * rate)) + delta
+        padded = np.concatenate((np.zeros(pad, dtype=np.float32), data,
+                                 np.zeros(int(nframes * hop * rate) + framelen + 2 * pad, dtype=np.float32)))
+        nominal = pad + np.round((np.arange(nframes) - 1) * hop * rate).astype(np.int64)
+
+        # every candidate frame around every nominal position, as a (frames, shifts, framelen) view
+        candidates = np.lib.stride_tricks.sliding_window_view(padded, framelen)
+        shifts = np.arange(-delta, delta + 1)
+
+        starts = nominal.copy()
+        for k in range(1, nframes):
+            # the natural continuation of the previous frame, compared with each candidate
+            target = padded[starts[k - 1] + hop:starts[k - 1] + hop + framelen]
+            similarity = candidates[nominal[k] - delta:nominal[k] + delta + 1] @ target
+            starts[k] = nominal[k] + shifts[np.argmax(similarity)]
+
+        # windowed frames, overlap-added by summing the two halves of neighbouring frames
+        window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(framelen) / framelen)
+        frames = candidates[starts] * window
+        out = np.zeros((nframes + 1, hop), dtype=np.float32)
+        out[:-1] += frames[:, :hop]
+        out[1:] += frames[:, hop:]
+
+        # drop the first (fading in) half frame
+        out = out.reshape(-1)[hop:hop + outlen]
+        self.new_object.data = np.clip(np.round(out), -32768, 32767).astype(np.int16)
+
+    def emergency_diphone(self,lostkey,diphones=None):
         """
         Select an emergency diphone by using regex, this
         function will look through the dictionary's keys
         to find a key that is a near orthographic match
         to the lost key
         :param lostkey a key not in the dictionary
+        :param diphones: the diphones dictionary to search (self.diphones by default)
         :return: a new key to search
         """
         # midpoint of current diphone key
@@ -248,7 +623,7 @@ class Synth:
                     s.substitute(a=fragmentformer, b=star)
                     ideal_key = '{0}{1}'.format(fragmentformer, star)
 
-                for k in self.diphones.keys():
+                for k in (self.diphones if diphones is None else diphones).keys():
                     if re.match(ideal_key,k):
                         strings=['{} found'.format(k)]
                         printdots(strings)
@@ -260,6 +635,472 @@ class Synth:
 
 
 
+class SharedBank:
+    """
+    The diphone audio, its index and the lexicon held once in shared memory.
+
+    One manager process builds the bank with create(); every worker then
+    attaches to it by name and only receives read-only numpy views onto the
+    shared block, so adding a worker adds almost no resident memory.
+    """
+    headerlen = 8
+    align = 8
+
+    def __init__(self, shm, layout, owner=False):
+        self.shm = shm
+        self.owner = owner
+        self.rate = layout['rate']
+        self.fingerprint = layout.get('fingerprint')
+        self.arrays = {}
+
+        start = self.data_start(layout['headerlen'])
+        for key, (dtype, shape, offset) in layout['arrays'].items():
+            array = np.ndarray(tuple(shape), dtype=np.dtype(dtype), buffer=shm.buf, offset=start + offset)
+            array.flags.writeable = False
+            self.arrays[key] = array
+
+        self.lexicon = Lexicon(self.arrays) if 'words' in self.arrays else None
+
+    @classmethod
+    def create(cls, wav_folder, name=None, lexicon=None, rate=16000, manifest=None):
+        """
+        Loads every diphone wav under wav_folder (and, optionally, a
+        lexicon) into a new shared memory block.
+
+        :param wav_folder: diphones directory
+        :param name: the name workers will attach with (random if None)
+        :param lexicon: a Lexicon to share alongside the audio
+        :param rate: the sampling rate of the diphone wavs
+        :param manifest: a Manifest of wav_folder, to avoid walking and hashing it again
+        :return: a SharedBank that owns the block
+        """
+        files = {}
+        if manifest is not None:
+            manifest.update()
+            for diphone, entry in manifest.entries.items():
+                files[diphone] = os.path.join(wav_folder, entry['file'])
+        else:
+            files = wav_files(wav_folder)
+
+        names = sorted(files)
+        sound = simpleaudio.Audio(rate=rate)
+        wavs = []
+        for diphone in names:
+            sound.load(files[diphone])
+            wavs.append(np.asarray(sound.data, dtype=np.int16))
+
+        arrays = {'names': np.array([n.encode('utf-8') for n in names], dtype=bytes),
+                  'offsets': np.cumsum([0] + [len(w) for w in wavs], dtype=np.int64),
+                  'audio': np.concatenate(wavs) if wavs else np.zeros(0, dtype=np.int16)}
+
+        if lexicon is not None:
+            arrays.update(lexicon.arrays)
+
+        fingerprint = manifest.fingerprint() if manifest is not None else fingerprint_files(files)
+        if lexicon is not None:
+            fingerprint = combine_fingerprints(fingerprint, lexicon.fingerprint())
+        return cls.publish(arrays, name=name, rate=sound.rate, fingerprint=fingerprint)
+
+    @classmethod
+    def publish(cls, arrays, name=None, rate=16000, fingerprint=None):
+        """
+        Copies a dict of numpy arrays into a new shared memory block
+        preceded by a small json header describing where each one lives.
+
+        :param arrays: a dict of numpy arrays
+        :param name: the shared memory name (random if None)
+        :param rate: the sampling rate of the audio
+        :param fingerprint: the hash of the diphone files the audio came from (and of the lexicon)
+        :return: a SharedBank that owns the block
+        """
+        # Array offsets are relative to the end of the header, which is padded to the alignment
+        layout = {'rate': rate, 'fingerprint': fingerprint, 'arrays': {}}
+        position = 0
+        for key, array in arrays.items():
+            position += -position % cls.align
+            layout['arrays'][key] = [array.dtype.str, list(array.shape), position]
+            position += array.nbytes
+
+        header = json.dumps(layout).encode('utf-8')
+        start = cls.data_start(len(header))
+
+        shm = shared_memory.SharedMemory(name=name, create=True, size=max(start + position, 1))
+        shm.buf[:cls.headerlen] = len(header).to_bytes(cls.headerlen, 'little')
+        shm.buf[cls.headerlen:cls.headerlen + len(header)] = header
+
+        for key, array in arrays.items():
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf,
+                              offset=start + layout['arrays'][key][2])
+            view[...] = array
+            del view
+
+        layout['headerlen'] = len(header)
+        return cls(shm, layout, owner=True)
+
+    @classmethod
+    def data_start(cls, length):
+        """
+        :param length: the length of the json header in bytes
+        :return: the aligned offset at which the arrays begin
+        """
+        start = cls.headerlen + length
+        return start + (-start % cls.align)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Attaches to a bank published by another process.
+
+        :param name: the name the bank was published under
+        :return: a read-only SharedBank
+        """
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before python 3.13 every attaching process registers the block with its
+            # resource tracker, which would unlink it when the worker exits
+            from multiprocessing import resource_tracker
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, 'shared_memory')
+
+        length = int.from_bytes(bytes(shm.buf[:cls.headerlen]), 'little')
+        layout = json.loads(bytes(shm.buf[cls.headerlen:cls.headerlen + length]).decode('utf-8'))
+        layout['headerlen'] = length
+
+        return cls(shm, layout)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def names(self):
+        """
+        :return: a list of the diphones held in the bank
+        """
+        return [n.decode('utf-8') for n in self.arrays['names']]
+
+    def wav(self, diphone):
+        """
+        Finds a diphone in the sorted index and returns its samples.
+
+        :param diphone: a diphone key, e.g. 'ah-m'
+        :return: a read-only int16 view onto the shared audio
+        """
+        names = self.arrays['names']
+        key = diphone.encode('utf-8')
+        i = int(np.searchsorted(names, key))
+        if i == len(names) or names[i] != key:
+            raise KeyError(diphone)
+
+        return self.unit(i)
+
+    def unit(self, i):
+        """
+        :param i: the position of a diphone in the index
+        :return: a read-only int16 view onto the shared audio
+        """
+        offsets = self.arrays['offsets']
+        return self.arrays['audio'][offsets[i]:offsets[i + 1]]
+
+    def close(self):
+        """
+        Drops the views and detaches from the block; the owner also
+        removes the block from the system.
+
+        :return: None
+        """
+        self.arrays = {}
+        self.lexicon = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class Lexicon:
+    """
+    A read-only, dict-like pronunciation lexicon compiled into numpy
+    arrays. Each pronunciation is an array of phone IDs, so a lexicon can
+    be looked up without any string processing and shared via a SharedBank.
+    """
+    def __init__(self, arrays):
+        self.arrays = {key: arrays[key] for key in ('words', 'word_offsets', 'pron_offsets', 'phones')}
+        self.words = arrays['words']
+        self.word_offsets = arrays['word_offsets']
+        self.pron_offsets = arrays['pron_offsets']
+        self.phones = arrays['phones']
+
+    @classmethod
+    def from_dict(cls, lexicon):
+        """
+        Compiles a cmudict-style dict, dropping stress from the phones.
+
+        :param lexicon: a dict of word -> list of pronunciations (lists of CMU phones)
+        :return: a Lexicon
+        """
+        words = sorted(lexicon)
+        prons = [pro for word in words for pro in lexicon[word]]
+        phones = [PHONE_IDS[phone.rstrip('012').lower()] for pro in prons for phone in pro]
+
+        return cls({'words': np.array([w.encode('utf-8') for w in words], dtype=bytes),
+                    'word_offsets': np.cumsum([0] + [len(lexicon[w]) for w in words], dtype=np.int64),
+                    'pron_offsets': np.cumsum([0] + [len(pro) for pro in prons], dtype=np.int64),
+                    'phones': np.array(phones, dtype=np.uint8)})
+
+    def index(self, word):
+        key = word.encode('utf-8')
+        i = int(np.searchsorted(self.words, key))
+        if i == len(self.words) or self.words[i] != key:
+            raise KeyError(word)
+        return i
+
+    def __getitem__(self, word):
+        """
+        :param word: a lower case word
+        :return: a list of pronunciations, each an array of phone IDs
+        """
+        i = self.index(word)
+        bounds = self.pron_offsets[self.word_offsets[i]:self.word_offsets[i + 1] + 1]
+        return [self.phones[bounds[j]:bounds[j + 1]] for j in range(len(bounds) - 1)]
+
+    def __contains__(self, word):
+        try:
+            self.index(word)
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.words)
+
+    def fingerprint(self):
+        """
+        :return: a hash of the compiled arrays, i.e. of every pronunciation
+        """
+        digest = hashlib.sha256()
+        for key in ('words', 'word_offsets', 'pron_offsets', 'phones'):
+            array = self.arrays[key]
+            digest.update('{}\0{}\0{}\0'.format(key, array.dtype.str, array.shape).encode('utf-8'))
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+
+class Manifest:
+    """
+    A persisted index of the diphone files: for each diphone its file,
+    size, modification time, number of samples and sha256 checksum.
+    Files whose size and modification time still match are not read again.
+    """
+    version = 1
+
+    def __init__(self, wav_folder, path):
+        self.wav_folder = wav_folder
+        self.path = path
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        """
+        Reads the saved manifest, if there is one for this folder.
+        :return: None
+        """
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+
+        if saved.get('version') == self.version:
+            self.entries = saved['entries']
+
+    def save(self):
+        """
+        Writes the manifest atomically, so that other processes never see
+        half of it; a folder that cannot be written to is only reported.
+        :return: None
+        """
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': self.version, 'entries': self.entries}, f)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            printdots(['Could not save the manifest {}'.format(self.path), '{}'.format(e)])
+
+    def update(self):
+        """
+        Stats every diphone file and reads only those that are new or whose
+        size or modification time changed. Files that cannot be read yet
+        (missing, or only partly written) are skipped until the next update.
+        :return: a tuple (set of added or changed diphones, set of removed diphones)
+        """
+        found = {}
+        for root, dirs, files in os.walk(self.wav_folder, topdown=False):
+            for file in files:
+                if file[0:2]!='._' and file.endswith('.wav'):
+                    found[re.sub('(.wav)','',file)] = os.path.relpath(os.path.join(root, file), self.wav_folder)
+
+        changed = set()
+        dirty = False
+        for diphone, file in found.items():
+            entry = self.entries.get(diphone)
+            try:
+                stat = os.stat(os.path.join(self.wav_folder, file))
+                if entry and entry['file'] == file and entry['size'] == stat.st_size and \
+                        entry['mtime_ns'] == stat.st_mtime_ns:
+                    continue
+
+                with open(os.path.join(self.wav_folder, file), 'rb') as f:
+                    data = f.read()
+                with wave.open(io.BytesIO(data), 'rb') as w:
+                    samples = w.getnframes()
+                    if len(w.readframes(samples)) < samples * w.getsampwidth() * w.getnchannels():
+                        raise EOFError('only part of the audio is there')
+
+            # The file may be being renamed or copied into place: keep what
+            # was known about it and look again at the next update
+            except (OSError, EOFError, wave.Error) as e:
+                printdots(['Skipping {} for now: {}'.format(file, e)])
+                continue
+
+            checksum = hashlib.sha256(data).hexdigest()
+
+            # a file that was only touched keeps its audio
+            if not entry or entry['sha256'] != checksum or entry['file'] != file:
+                changed.add(diphone)
+            self.entries[diphone] = {'file': file, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                     'samples': samples, 'sha256': checksum}
+            dirty = True
+
+        removed = set(self.entries) - set(found)
+        for diphone in removed:
+            del self.entries[diphone]
+
+        if dirty or removed:
+            self.save()
+        return changed, removed
+
+    def fingerprint(self):
+        """
+        :return: the same hash as fingerprint_files, from the saved checksums
+        """
+        return fingerprint_checksums({d: entry['sha256'] for d, entry in self.entries.items()})
+
+
+class AudioCache:
+    """
+    An on-disk cache of rendered WAV files, addressed by a hash of the
+    normalised phrase, the synthesis options and the bank fingerprint, so
+    that a change to either gives new entries and the old ones age out.
+
+    Entries are written to a temporary file and renamed into place, so
+    several processes can share one cache folder. About one put in
+    evict_every walks the folder and deletes the least recently used
+    entries once it has grown past max_bytes (so it can overshoot by a
+    few entries), along with temporary files left by killed writers.
+    """
+    evict_every = 16
+    stale_seconds = 300
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(phrase, options, fingerprint):
+        """
+        :param phrase: the phrase to be synthesised
+        :param options: a dict of the options that change the audio
+        :param fingerprint: the fingerprint of the diphone bank
+        :return: a hex digest addressing the rendered audio
+        """
+        normalised = ' '.join(phrase.lower().split())
+        spec = json.dumps({'phrase': normalised, 'options': options, 'bank': fingerprint}, sort_keys=True)
+        return hashlib.sha256(spec.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], key + '.wav')
+
+    def get(self, key):
+        """
+        :param key: a key from AudioCache.key
+        :return: the cached WAV bytes, or None
+        """
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        # Mark the entry as recently used (it may have been evicted meanwhile)
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """
+        Atomically stores WAV bytes under a key, then now and again evicts
+        old entries if the cache has grown too large.
+        :param key: a key from AudioCache.key
+        :param data: WAV bytes
+        :return: None
+        """
+        folder = os.path.dirname(self.path(key))
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+        # Each put is usually a separate process, so sample rather than count
+        if random.randrange(self.evict_every) == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Deletes temporary files older than stale_seconds, then the least
+        recently used entries until the cache is below 90% of max_bytes.
+        Temporary files still being written count towards the size.
+        :return: None
+        """
+        entries = []
+        total = 0
+        now = time.time()
+        for root, dirs, files in os.walk(self.folder):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                    if file.endswith('.tmp') and now - stat.st_mtime > self.stale_seconds:
+                        os.remove(path)
+                        continue
+                except FileNotFoundError:
+                    continue
+
+                total += stat.st_size
+                if file.endswith('.wav'):
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+        if total <= self.max_bytes:
+            return
+
+        for mtime, size, path in sorted(entries):
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
 class Utterance:
     """
     Front end: change raw input into a linguistic specification for synthesis.
@@ -313,7 +1154,7 @@ class Utterance:
         """
         pro=list()
         for j in unk:
-            pro.append(cmu[j][i])
+            pro.append(get_lexicon()[j][i])
             print(j)
         return pro
 
@@ -336,11 +1177,11 @@ class Utterance:
 
             try:
                 # If a pronunciation exists in the dictionary...
-                if cmu[chars][i]:
+                if len(get_lexicon()[chars][i]):
                     # Add to flag, append pron_attempt and return to the function
                     # with variables updates.
                     flag += 1
-                    pron_attempt.append(cmu[chars][i])
+                    pron_attempt.append(get_lexicon()[chars][i])
                     return self.unknownword(pron_attempt,unkword[index:],i, flag)
             # Naturally, there will be keyerrors attempting
             # to index the cmudict with nonsense
@@ -390,6 +1231,9 @@ class Utterance:
         # Preprocess step 3b: delete the remaining punctuation & update self.phrase
         self.delpunct()
 
+        # Keep track of the words that are not in the lexicon
+        self.oov=list()
+
         # Create a diphone word-marking list to keep track of words that become phones
         self.dp_word_em_marker=list()
 
@@ -402,15 +1246,18 @@ class Utterance:
             # Decide on a method later to choose an index depending on the word POS
             index_to_choose=0
 
-            # Load a word:
+            # Load a word (a token that was only punctuation is empty by now,
+            # and only brings back its pause below):
             try:
-                pronunciation.append(cmu[word][index_to_choose])
+                if word:
+                    pronunciation.append(get_lexicon()[word][index_to_choose])
 
             except Exception as e:
                 strings=['Error looking up {}'.format(e),
                          'Exception handler invoked to create a phone sequence']
                 printdots(strings)
 
+                self.oov.append(word)
                 unk=self.unknownword( [],word, index_to_choose, 0)
                 print(pronunciation.append(unk))
 
@@ -428,7 +1275,7 @@ class Utterance:
             except:
                 continue
 
-        # Return only the diphones list by joining the phones using '<phone>-<phone>'
+        # Return only the diphone sequence, as pairs of neighbouring phone IDs
         return self.diphones_from_cmu_seq(pronunciation)
 
     def clean(self):
@@ -703,35 +1550,34 @@ class Utterance:
         """
         Initialise CMU sequence, add pauses, and
         turn into a diphone sequence
-        :param pronunciation: the raw pronunciation from cmudict
-        :return: a tuple of diphones
+        :param pronunciation: the pronunciations (arrays of phone IDs) from the lexicon,
+        with punctuation markers in between
+        :return: a DiphoneSeq
         """
-        phonelist=[] # first, make a phonelist
-
-        for cmupro in range(len(pronunciation)):
-            for token in range(len(pronunciation[cmupro])):
-
-                if pronunciation[cmupro][token] in '.:?!': # Some punctuation requires longer pauses
-                    phonelist.append('pau4') # 400ms
-
-                elif pronunciation[cmupro][token] in ',': # Other punctuation requires shorter pauses
-                    phonelist.append('pau2') # 200ms
-
-                else: # Most cases just require CMU substitution.
-                    phonelist.append(re.sub('[0-9]', '', pronunciation[cmupro][token].lower()))
+        phones=[] # first, make a phone ID array and a parallel array of pause lengths
+        pauses=[]
 
-            if cmupro==len(pronunciation)-1 and phonelist[-1][-3:]!='pau': # Append pause
-                phonelist.append('pau4')  # 400ms
+        for pro in pronunciation:
+            if pro is None: # nothing could be found for an unknown word
+                continue
 
-        diphonelist=[]
+            if len(pro) and isinstance(pro[0], str): # Punctuation requires a pause (200ms or 400ms)
+                phones.append(np.array([PAU], dtype=np.uint8))
+                pauses.append(np.array([PAUSE_LENGTHS.get(pro[0], 400)], dtype=np.int16))
 
-        for phone in range(len(phonelist)-1): # This for loop creates the diphones using phonelist indicies
+            else: # Most cases just require the phone IDs from the lexicon
+                phones.append(np.asarray(pro, dtype=np.uint8))
+                pauses.append(np.zeros(len(phones[-1]), dtype=np.int16))
 
-            diphonelist.append(str(phonelist[phone]+'-'+phonelist[phone+1]))
+        if phones: # Append pause
+            phones.append(np.array([PAU], dtype=np.uint8))
+            pauses.append(np.array([400], dtype=np.int16)) # 400ms
 
-        del phonelist
+        phones = np.concatenate(phones) if phones else np.zeros(0, dtype=np.uint8)
+        pauses = np.concatenate(pauses) if pauses else np.zeros(0, dtype=np.int16)
 
-        return tuple(diphonelist)
+        # The diphones are the pairs of neighbouring phones; each is followed by the pause of its right phone
+        return DiphoneSeq(phones[:-1], phones[1:], pauses[1:])
 
     def punctuation(self):
         """
@@ -764,6 +1610,155 @@ class Utterance:
 
         self.phrase=q
 
+def get_lexicon():
+    """
+    Returns the pronunciation Lexicon, compiling it from cmudict on
+    first use unless one has been set (e.g. from a shared bank)
+    :return: a Lexicon
+    """
+    global cmu
+    if cmu is None:
+        cmu = Lexicon.from_dict(cmudict.dict())
+    return cmu
+
+def wav_files(wav_folder):
+    """
+    Lists the diphone files under a folder
+    :param wav_folder: diphones directory
+    :return: a dict of diphone -> path
+    """
+    files = {}
+    for root, dirs, filenames in os.walk(wav_folder, topdown=False):
+        for file in filenames:
+            if file[0:2]!='._' and file.endswith('.wav'):
+                files[re.sub('(.wav)','',file)] = os.path.join(root, file)
+    return files
+
+def bank_fingerprint(wav_folder, bank=None, manifest=None, lexicon_memo=None):
+    """
+    Identifies the contents of a diphone bank and of the lexicon that
+    chooses its units, without loading the bank. A shared bank carries a
+    hash of its file contents and lexicon; a manifest carries a hash of the
+    file contents; a plain folder is only stamped by the names, sizes and
+    modification times of its files (stamp_files), which is much cheaper
+    than reading every file but misses an edit that keeps both the size and
+    the modification time. The lexicon comes from lexicon_fingerprint.
+    :param wav_folder: diphones directory
+    :param bank: a SharedBank, if one is used
+    :param manifest: an up to date Manifest of wav_folder, if one is used
+    :param lexicon_memo: passed on to lexicon_fingerprint
+    :return: a hex digest
+    """
+    if bank is not None and bank.lexicon is not None:
+        return bank.fingerprint
+    if bank is not None:
+        audio = bank.fingerprint
+    elif manifest is not None:
+        audio = manifest.fingerprint()
+    else:
+        audio = stamp_files(wav_files(wav_folder))
+    return combine_fingerprints(audio, lexicon_fingerprint(lexicon_memo))
+
+def lexicon_fingerprint(memo=None):
+    """
+    Hashes the compiled lexicon. If it has not been loaded yet and a memo
+    file is given, the hash is looked up there by the name, size and
+    modification time of the cmudict source, so that the lexicon is only
+    compiled when cmudict changes.
+    :param memo: a json file remembering the hash of each cmudict source
+    :return: a hex digest
+    """
+    if cmu is not None or memo is None:
+        return get_lexicon().fingerprint()
+
+    pointer = cmudict.abspath('cmudict')
+    source = getattr(pointer, 'path', None) or pointer.zipfile.filename
+    stat = os.stat(source)
+    stamp = '{} {} {} {}'.format(source, stat.st_size, stat.st_mtime_ns, ' '.join(PHONES))
+
+    try:
+        with open(memo) as f:
+            known = json.load(f)
+    except (FileNotFoundError, ValueError):
+        known = {}
+    if stamp in known:
+        return known[stamp]
+
+    known[stamp] = get_lexicon().fingerprint()
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(memo)), suffix='.json.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(known, f)
+        os.replace(tmp, memo)
+    except OSError as e:
+        printdots(['Could not save {}: {}'.format(memo, e)])
+    return known[stamp]
+
+def combine_fingerprints(*digests):
+    """
+    :param digests: hex digests
+    :return: one hex digest of all of them, in order
+    """
+    return hashlib.sha256('\0'.join(digests).encode('utf-8')).hexdigest()
+
+def stamp_files(files):
+    """
+    Hashes the names, sizes and modification times of a set of diphone files
+    :param files: a dict of diphone -> path
+    :return: a hex digest
+    """
+    digest = hashlib.sha256()
+    for diphone in sorted(files):
+        stat = os.stat(files[diphone])
+        digest.update('{}\0{}\0{}\0'.format(diphone, stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return digest.hexdigest()
+
+def fingerprint_files(files):
+    """
+    Hashes the names and contents of a set of diphone files
+    :param files: a dict of diphone -> path
+    :return: a hex digest
+    """
+    checksums = {}
+    for diphone, path in files.items():
+        with open(path, 'rb') as f:
+            checksums[diphone] = hashlib.sha256(f.read()).hexdigest()
+    return fingerprint_checksums(checksums)
+
+def fingerprint_checksums(checksums):
+    """
+    Combines the checksums of a set of diphone files into one hash
+    :param checksums: a dict of diphone -> sha256 hex digest of its file
+    :return: a hex digest
+    """
+    digest = hashlib.sha256()
+    for diphone in sorted(checksums):
+        digest.update(diphone.encode('utf-8') + b'\0' + bytes.fromhex(checksums[diphone]))
+    return digest.hexdigest()
+
+def wav_bytes(audio):
+    """
+    Encodes an audio object as the bytes of a 16 bit mono WAV file
+    :param audio: a simpleaudio.Audio
+    :return: bytes
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(audio.rate)
+        w.writeframes(np.asarray(audio.data, dtype=np.int16).tobytes())
+    return buffer.getvalue()
+
+def wav_data(data):
+    """
+    Decodes the bytes of a 16 bit mono WAV file
+    :param data: bytes
+    :return: an int16 numpy array
+    """
+    with wave.open(io.BytesIO(data), 'rb') as w:
+        return np.frombuffer(w.readframes(w.getnframes()), dtype=np.int16).copy()
+
 def printdots(strings):
     """
     takes a list of strings and prints them nicely
@@ -784,23 +1779,150 @@ def welcome():
              ]
     printdots(strings)
 
+def serve_bank(name):
+    """
+    Publishes the diphones and the lexicon in shared memory and keeps
+    them alive until interrupted, so that workers can use --bank
+    :param name: the name workers attach with
+    :return: None
+    """
+    manifest = Manifest(args.diphones, args.manifest) if args.manifest else None
+    bank = SharedBank.create(args.diphones, name=name, lexicon=get_lexicon(), manifest=manifest)
+    printdots(['Serving {} diphones and {} words as shared bank {}'.format(
+        len(bank.arrays['names']), len(bank.lexicon), bank.name), 'Press Ctrl-C to stop'])
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bank.close()
+
+def build_domain_bank(corpus, outdir, report=None):
+    """
+    Runs every line of a domain corpus through the front end, collects
+    the diphones it needs (with the emergency diphones that stand in for
+    missing ones) and copies only those wavs into a new diphones folder.
+    :param corpus: a text file with one phrase per line
+    :param outdir: the folder to write the minimal bank to
+    :param report: a file to save the coverage report to as json
+    :return: the coverage report dict
+    """
+    synth = Synth(wav_folder=args.diphones, manifest=Manifest(args.diphones, args.manifest) if args.manifest else None)
+    needed = {}
+    tokens = 0
+    lines = 0
+
+    with open(corpus) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            lines += 1
+            diphoneseq = Utterance(line.strip()).get_phone_seq()
+            tokens += len(diphoneseq.left)
+            for diphone in diphoneseq.names():
+                needed[diphone] = needed.get(diphone, 0) + 1
+
+    present = [d for d in needed if d in synth.diphones]
+    fallbacks = {d: synth.emergency_diphone(d) for d in needed if d not in synth.diphones}
+    missing = sorted(d for d, backupkey in fallbacks.items() if backupkey is None)
+    keep = sorted(set(present) | set(k for k in fallbacks.values() if k is not None))
+
+    os.makedirs(outdir, exist_ok=True)
+    for diphone in keep:
+        shutil.copy2(os.path.join(args.diphones, synth.diphones[diphone]), outdir)
+
+    size = lambda diphones: sum(os.path.getsize(os.path.join(args.diphones, synth.diphones[d])) for d in diphones)
+    coverage = {'lines': lines,
+                'diphone_tokens': tokens,
+                'diphones_needed': len(needed),
+                'diphones_present': len(present),
+                'token_coverage': sum(needed[d] for d in present) / tokens if tokens else 1.0,
+                'fallbacks': {d: k for d, k in sorted(fallbacks.items()) if k is not None},
+                'missing': missing,
+                'units_kept': len(keep),
+                'units_in_bank': len(synth.diphones),
+                'bytes_kept': size(keep),
+                'bytes_in_bank': size(synth.diphones)}
+
+    if report:
+        with open(report, 'w') as f:
+            json.dump(coverage, f, indent=2)
+
+    printdots(['Built a bank of {} out of {} diphones ({} of {} bytes) in {}'.format(
+                   len(keep), len(synth.diphones), coverage['bytes_kept'], coverage['bytes_in_bank'], outdir),
+               '{} of {} diphones needed by {} lines are present ({:.1%} of diphone tokens)'.format(
+                   len(present), len(needed), lines, coverage['token_coverage']),
+               '{} filled in by emergency diphones, {} with no fallback'.format(
+                   len(coverage['fallbacks']), len(missing))])
+    return coverage
+
 if __name__ == "__main__":
-    welcome()
-    utt = Utterance(args.phrase[0])
-    diphone_seq = utt.get_phone_seq()
-    diphone_dict = Synth(wav_folder=args.diphones)
-    dataobjectout=diphone_dict.synthesize(diphone_seq, args.crossfade)
-
-    # Volume rescaling option
-    if args.volume: dataobjectout.rescale(args.volume / 100)
+    welcome() if not args.estimate else None
+    bank = SharedBank.attach(args.bank) if args.bank else None
+    if bank is not None:
+        cmu = bank.lexicon
+
+    if args.publish_bank:
+        serve_bank(args.publish_bank)
+        raise SystemExit
+    if args.build_bank:
+        build_domain_bank(*args.build_bank, report=args.coverage_report)
+        raise SystemExit
+    if args.phrase is None:
+        parser.error('the following arguments are required: phrase')
+    if args.rate <= 0 or (args.pause_rate is not None and args.pause_rate <= 0):
+        parser.error('--rate and --pause-rate must be greater than 0')
+
+    manifest = Manifest(args.diphones, args.manifest) if args.manifest and bank is None else None
+
+    # Estimate option: stdout only gets the json, everything else goes to stderr
+    if args.estimate:
+        with contextlib.redirect_stdout(sys.stderr):
+            diphone_dict = Synth(wav_folder=args.diphones, bank=bank, manifest=manifest)
+            estimate = diphone_dict.estimate_phrase(args.phrase, args.crossfade, rate=args.rate,
+                                                    pause_rate=args.pause_rate)
+        print(json.dumps(estimate))
+        raise SystemExit
+
+    # Look for identical earlier requests in the cache, before loading the lexicon or the diphones
+    cache = AudioCache(args.cache, args.cache_size * 1024 * 1024) if args.cache else None
+    wav = None
+    if cache is not None:
+        options = {'spell': args.spell, 'crossfade': args.crossfade, 'volume': args.volume,
+                   'rate': args.rate, 'pause_rate': args.pause_rate}
+        manifest.update() if manifest is not None else None
+        key = AudioCache.key(args.phrase, options, bank_fingerprint(args.diphones, bank, manifest,
+                                                                    os.path.join(args.cache, 'lexicon.json')))
+        wav = cache.get(key)
+
     # Create the audio object
     out = simpleaudio.Audio(rate=16000)
-    out.data = dataobjectout.data
+
+    if wav is not None:
+        out.data = wav_data(wav)
+    else:
+        diphone_dict = Synth(wav_folder=args.diphones, bank=bank, manifest=manifest)
+        utt = Utterance(args.phrase)
+        diphone_seq = utt.get_phone_seq()
+        dataobjectout=diphone_dict.synthesize(diphone_seq, args.crossfade, rate=args.rate, pause_rate=args.pause_rate)
+
+        # Volume rescaling option
+        if args.volume: dataobjectout.rescale(args.volume / 100)
+        out.data = dataobjectout.data
+        if cache is not None:
+            wav = wav_bytes(out)
+            cache.put(key, wav)
+
     # Play option
     if args.play: out.play()
 
     # Save option
     if args.outfile:
-        out.save(args.outfile)
+        if wav is not None:
+            with open(args.outfile, 'wb') as f:
+                f.write(wav)
+        else:
+            out.save(args.outfile)
         strings=['Your file have been saved as {}'.format(args.outfile)]
         printdots(strings)